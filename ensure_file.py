@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 import argparse
+import collections
 import difflib
+import functools
+import mmap
+import os
 import re
 import sys
+import tempfile
 from pathlib import Path
 
 EXIT_OK = 0
@@ -12,30 +17,251 @@ EXIT_NO_MATCH = 3
 EXIT_NO_CHANGE_NEEDED = 4
 EXIT_NOT_FOUND = 5
 
+# Files at least this large are checked for an in-place block via mmap
+MMAP_THRESHOLD = 1 << 20
+# Diffs of at least this many bytes are trimmed to the changed lines before
+# difflib sees them
+DIFF_TRIM_THRESHOLD = 4096
+# Bytes that bytes.strip() removes
+WHITESPACE = b" \t\n\r\x0b\x0c"
+
+# ASCII bytes that str \s matches but bytes \s does not
+STR_ONLY_SPACE = re.compile(rb"[\x1c-\x1f]")
+
+# Boundaries recognised by bytes.splitlines()
+LINE_BREAKS = b"\n\r"
+
+# A unified diff hunk header: @@ -start[,len] +start[,len] @@
+HUNK_HEADER = re.compile(rb"^@@ -(\d+)(,\d+)? \+(\d+)(,\d+)? @@")
+
+# One contiguous change: the `old` lines starting at index `lineno` become `new`
+Edit = collections.namedtuple("Edit", "lineno old new")
+
+def to_bytes(text):
+    """Encode a command-line string; undecodable argv bytes round-trip unchanged."""
+    return text.encode("utf-8", "surrogateescape")
+
+def as_text(data):
+    """Decode file bytes for display."""
+    return data.decode("utf-8", "replace")
+
+@functools.lru_cache(maxsize=256)
+def compile_pattern(pattern):
+    """re.compile(), memoized so repeated run()/batch() calls in one process
+    don't recompile the same pattern."""
+    return re.compile(pattern)
+
 def exit_ok_or_noop(idempotent_ok):
     sys.exit(EXIT_OK if idempotent_ok else EXIT_NO_CHANGE_NEEDED)
 
-def show_diff_and_confirm(old, new, path, force=False, quiet=False):
+def unified_range(start, stop):
+    """Format a hunk range the way difflib.unified_diff does."""
+    length = stop - start
+    if length == 1:
+        return f"{start + 1}"
+    if not length:
+        return f"{start},0"
+    return f"{start + 1},{length}"
+
+def format_edits(path, lines, edits, context=3, offset=0):
+    """Yield a unified diff of `edits` against the old `lines`, grouping hunks
+    like difflib but without running its SequenceMatcher over the file.
+    `offset` is the line number of lines[0] when they are a window of the file."""
+    yield f"--- {path}.old\n"
+    yield f"+++ {path}.new\n"
+    groups = []
+    for e in edits:
+        if groups:
+            prev = groups[-1][-1]
+            gap = e.lineno - (prev.lineno + len(prev.old))
+            if not gap:
+                groups[-1][-1] = Edit(prev.lineno, prev.old + e.old, prev.new + e.new)
+                continue
+            if gap <= 2 * context:
+                groups[-1].append(e)
+                continue
+        groups.append([e])
+    shift = 0
+    for group in groups:
+        first, last = group[0], group[-1]
+        i1 = max(0, first.lineno - context)
+        i2 = min(len(lines), last.lineno + len(last.old) + context)
+        grown = sum(len(e.new) - len(e.old) for e in group)
+        old_range = unified_range(i1 + offset, i2 + offset)
+        new_range = unified_range(i1 + offset + shift, i2 + offset + shift + grown)
+        yield f"@@ -{old_range} +{new_range} @@\n"
+        i = i1
+        for e in group:
+            for l in lines[i:e.lineno]:
+                yield f" {as_text(l)}\n"
+            for l in e.old:
+                yield f"-{as_text(l)}\n"
+            for l in e.new:
+                yield f"+{as_text(l)}\n"
+            i = e.lineno + len(e.old)
+        for l in lines[i:i2]:
+            yield f" {as_text(l)}\n"
+        shift += grown
+
+def line_ending(text):
+    """Return CRLF if the first line of `text` ends in one, else LF."""
+    i = text.find(b"\n")
+    return b"\r\n" if i > 0 and text[i - 1] == 0x0d else b"\n"
+
+def has_plain_endings(text):
+    """Return True if every line of `text`, the last included, ends with the
+    same terminator, either all LF or all CRLF."""
+    if text and not text.endswith(b"\n"):
+        return False
+    crs = text.count(b"\r")
+    return not crs or crs == text.count(b"\n") == text.count(b"\r\n")
+
+def is_plain_lines(text, lines):
+    """Return True if `text` is just `lines` joined and terminated by newlines,
+    so per-line edits against `lines` describe every change to the file."""
+    return (text.endswith(b"\n") and text.count(b"\n") == len(lines)
+            and has_plain_endings(text))
+
+def split_lines(data):
+    """Split on newline bytes only, without a trailing empty line."""
+    lines = data.split(b"\n")
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+def common_prefix(a, b, step=4096):
+    """Return the length of the common prefix of `a` and `b`."""
+    n = min(len(a), len(b))
+    i = 0
+    while i < n:
+        j = min(i + step, n)
+        if a[i:j] != b[i:j]:
+            while a[i] == b[i]:
+                i += 1
+            return i
+        i = j
+    return n
+
+def change_window(old, new, context=3):
+    """Find the lines of `old` that differ from `new`.
+
+    Returns (before, start, end, after): old[start:end] holds the changed
+    lines and old[before:after] adds `context` lines either side. The same
+    spans end len(new) - len(old) bytes later in `new`."""
+    p = common_prefix(old, new)
+    limit = min(len(old), len(new)) - p
+    s = common_prefix(old[::-1], new[::-1])
+    s = min(s, limit)
+    start = old.rfind(b"\n", 0, p) + 1
+    k = old.find(b"\n", len(old) - s)
+    old_end = len(old) if k < 0 else k + 1
+    before = start
+    for _ in range(context):
+        if not before:
+            break
+        before = old.rfind(b"\n", 0, before - 1) + 1
+    after = old_end
+    for _ in range(context):
+        if after >= len(old):
+            break
+        k = old.find(b"\n", after)
+        after = len(old) if k < 0 else k + 1
+    return before, start, old_end, after
+
+def trimmed_edits(old, new, context=3):
+    """Reduce `old` -> `new` to the lines between their common leading and
+    trailing lines, and diff only those with difflib.
+
+    Returns (lines, edits, offset): a window of old lines holding the change
+    and `context` lines either side, the edits within it, and the line
+    number the window starts at."""
+    before, start, old_end, after = change_window(old, new, context)
+    new_end = old_end - len(old) + len(new)
+    old_mid = split_lines(old[start:old_end])
+    new_mid = split_lines(new[start:new_end])
+    base = old.count(b"\n", before, start)
+    matcher = difflib.SequenceMatcher(None, old_mid, new_mid)
+    edits = [Edit(base + i1, old_mid[i1:i2], new_mid[j1:j2])
+             for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"]
+    return split_lines(old[before:after]), edits, old.count(b"\n", 0, before)
+
+def shift_hunk(line, offset):
+    """Add `offset` to the line numbers of a unified diff hunk header."""
+    if not offset or not line.startswith(b"@@ "):
+        return line
+    return HUNK_HEADER.sub(lambda m: b"@@ -%d%s +%d%s @@" % (
+        int(m[1]) + offset, m[2] or b"", int(m[3]) + offset, m[4] or b""), line)
+
+def diff_lines(old, new, path, lines=None, edits=None):
+    """Yield the unified diff of `old` to `new`, built from `edits` when the
+    caller knows them and from difflib otherwise. Large inputs without known
+    edits are trimmed to the changed region first."""
+    if edits is not None:
+        return format_edits(path, lines, edits)
+    offset = 0
+    if len(old) + len(new) >= DIFF_TRIM_THRESHOLD:
+        if (has_plain_endings(old) and has_plain_endings(new)
+                and (b"\r" in old) == (b"\r" in new)):
+            lines, edits, offset = trimmed_edits(old, new)
+            return format_edits(path, lines, edits, offset=offset)
+        # a change to line terminators is lost when splitting on \n, so let
+        # difflib compare the window with its terminators kept
+        before, _, _, after = change_window(old, new)
+        offset = len(old[:before].splitlines())
+        old, new = old[before:after], new[before:after + len(new) - len(old)]
+    return (as_text(shift_hunk(line, offset)) for line in difflib.diff_bytes(
+        difflib.unified_diff,
+        old.splitlines(keepends=True),
+        new.splitlines(keepends=True),
+        fromfile=os.fsencode(f"{path}.old"),
+        tofile=os.fsencode(f"{path}.new")
+    ))
+
+def compute_diff(old, new, path, lines=None, edits=None):
+    """Return the unified diff of `old` to `new` as a string, or None if unchanged."""
+    if old == new:
+        return None
+    return "".join(diff_lines(old, new, path, lines, edits))
+
+def confirm(force=False):
+    if force:
+        return True
+    resp = input("Apply changes? [y/N]: ").strip().lower()
+    return resp == "y"
+
+def show_diff_and_confirm(old, new, path, force=False, quiet=False, lines=None, edits=None):
     if old == new:
         if not quiet:
             print(f"No changes needed for {path}")
         return None  # signal "no change"
+    if force and quiet:
+        return True
     if not quiet:
-        diff = list(difflib.unified_diff(
-            old.splitlines(keepends=True),
-            new.splitlines(keepends=True),
-            fromfile=f"{path}.old",
-            tofile=f"{path}.new"
-        ))
-        print("".join(diff))
-    if force:
+        sys.stdout.writelines(diff_lines(old, new, path, lines, edits))
+        sys.stdout.write("\n")
+        sys.stdout.flush()
+    return confirm(force)
+
+def has_line(text, line):
+    """Return True if `line` is one of text.splitlines(), without splitting."""
+    if not line or any(c in LINE_BREAKS for c in line):
+        return line in text.splitlines()
+    if text == line:
         return True
-    resp = input("Apply changes? [y/N]: ").strip().lower()
-    return resp == "y"
+    # only boundary-delimited substring tests, so every scan stays in C
+    breaks = LINE_BREAKS if b"\r" in text else b"\n"
+    for i in range(len(breaks)):
+        before = breaks[i:i + 1]
+        if text.startswith(line + before) or text.endswith(before + line):
+            return True
+        for j in range(len(breaks)):
+            if before + line + breaks[j:j + 1] in text:
+                return True
+    return False
 
 def safe_read(path, quiet):
     try:
-        return path.read_text(encoding="utf-8")
+        return path.read_bytes()
     except FileNotFoundError:
         if not quiet:
             print(f"File not found: {path}", file=sys.stderr)
@@ -45,151 +271,368 @@ def safe_read(path, quiet):
             print(f"Permission denied: {path}", file=sys.stderr)
         sys.exit(EXIT_PERMISSIONS)
 
-def ensure_line(path, line, force=False, quiet=False, idempotent_ok=False):
-    path = Path(path)
-    old = safe_read(path, quiet) if path.exists() else ""
-    lines = old.splitlines()
-    if line in lines:
-        if not quiet:
-            print(f"Line already present in {path}")
-        exit_ok_or_noop(idempotent_ok)
-    lines.append(line)
-    new = '\n'.join(lines) + '\n'
-    confirmed = show_diff_and_confirm(old, new, path, force, quiet)
+def write_all(fd, data):
+    mv = memoryview(data)
+    while mv:
+        mv = mv[os.write(fd, mv):]
+
+def write_in_place(path, data):
+    """Truncate and rewrite `path`, keeping its inode, owner and mode."""
+    fd = os.open(path, os.O_WRONLY | os.O_TRUNC)
+    try:
+        write_all(fd, data)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def atomic_write(path, data):
+    """Write the bytes `data` to a temp file next to `path`, then rename it into
+    place. If the directory isn't writable, or the rename or the original
+    owner can't be carried over, the existing file is rewritten in place
+    instead, which is not atomic."""
+    target = os.path.realpath(path)
+    directory = os.path.dirname(target)
+    try:
+        st = os.stat(target)
+    except FileNotFoundError:
+        st = None
+    try:
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(target)}.")
+    except PermissionError:
+        if st is None:
+            raise
+        write_in_place(target, data)
+        return
+    try:
+        try:
+            if st is not None:
+                os.fchmod(fd, st.st_mode & 0o7777)
+                os.fchown(fd, st.st_uid, st.st_gid)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.fchmod(fd, 0o666 & ~umask)
+            write_all(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, target)
+    except BaseException as e:
+        os.unlink(tmp)
+        if st is not None and isinstance(e, PermissionError):
+            write_in_place(target, data)
+            return
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def confirm_and_write(buf, force=False, quiet=False, idempotent_ok=False,
+                      lines=None, edits=None):
+    confirmed = show_diff_and_confirm(buf.raw, buf.text, buf.path, force, quiet, lines, edits)
     if confirmed is None:
         exit_ok_or_noop(idempotent_ok)
     if confirmed:
         try:
-            path.write_text(new, encoding="utf-8")
+            buf.flush()
         except PermissionError:
             if not quiet:
-                print(f"Permission denied: {path}", file=sys.stderr)
+                print(f"Permission denied: {buf.path}", file=sys.stderr)
             sys.exit(EXIT_PERMISSIONS)
         if not quiet:
-            print(f"Updated {path}")
+            print(f"Updated {buf.path}")
         sys.exit(EXIT_OK)
     exit_ok_or_noop(idempotent_ok)
 
-def ensure_block(path, block_lines, marker_start, marker_end,
-                 force=False, quiet=False, idempotent_ok=True):
-    path = Path(path)
-    old = safe_read(path, quiet) if path.exists() else ""
-    block = '\n'.join([marker_start] + block_lines + [marker_end])
-
-    if marker_start in old and marker_end in old:
-        start = old.index(marker_start)
-        end = old.index(marker_end) + len(marker_end)
-        before = old[:start].rstrip()
-        after = old[end:].lstrip()
-        new = before + '\n' + block + '\n' + after
-    else:
-        prefix = old.rstrip()
-        if prefix:
-            new = prefix + '\n' + block + '\n'
+def append_line(old, line, eol=b'\n'):
+    """Return `old` with `line` added as its last line, terminated by `eol`."""
+    if not old or old.endswith(b'\n'):
+        return old + line + eol
+    return old + eol + line + eol
+
+def place_block(old, block, marker_start, marker_end, eol=b'\n'):
+    """Return `old` with the marked block replaced by `block`, or `block`
+    appended if the markers are missing, separated by `eol`."""
+    start = old.find(marker_start)
+    end_idx = old.find(marker_end, start + len(marker_start)) if start >= 0 else -1
+    if start >= 0 and end_idx >= 0:
+        end = end_idx + len(marker_end)
+        # trim whitespace around the old block by index, then build once
+        before_end = start
+        while before_end > 0 and old[before_end - 1] in WHITESPACE:
+            before_end -= 1
+        after_start = end
+        while after_start < len(old) and old[after_start] in WHITESPACE:
+            after_start += 1
+        return b''.join([old[:before_end], eol, block, eol, old[after_start:]])
+    prefix = old.rstrip()
+    if prefix:
+        return prefix + eol + block + eol
+    return block + eol
+
+def replace_lines(lines, old_line, new_line):
+    """Replace every `old_line` in `lines` in place and return the edits made."""
+    # list.index does the scanning in C; only matching lines are visited here
+    edits = []
+    i = -1
+    while True:
+        try:
+            i = lines.index(old_line, i + 1)
+        except ValueError:
+            return edits
+        lines[i] = new_line
+        edits.append(Edit(i, [old_line], [new_line]))
+
+def replace_lines_re(lines, compiled, replacement):
+    """Apply `compiled` to every line; return (new_lines, match_found, edits)."""
+    # map() keeps the per-line dispatch in C; sub() hands back the same
+    # object for lines it leaves alone, so comparing lists is cheap
+    new_lines = list(map(functools.partial(compiled.sub, replacement), lines))
+    if new_lines == lines:
+        return new_lines, any(map(compiled.search, lines)), []
+    edits = [Edit(i, [l], [new_l]) for i, (l, new_l) in enumerate(zip(lines, new_lines))
+             if new_l != l]
+    return new_lines, True, edits
+
+class FileBuffer:
+    """A file's contents as bytes, read once and written back once by flush().
+
+    The content is held as text, as a list of lines, or both, whichever the
+    last operation needed, so a run of line operations splits the file once
+    and a run of text operations never splits it at all. Lines written by any
+    operation use the terminator of the file's first line."""
+
+    def __init__(self, path, quiet=False, create=False):
+        self.path = path
+        self.raw = safe_read(path, quiet) if path.exists() or not create else b""
+        self.eol = line_ending(self.raw)
+        self._text = self.raw
+        self._lines = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.eol.join(self._lines) + self.eol if self._lines else b""
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+        self._lines = None
+
+    @property
+    def lines(self):
+        """The content split into lines; mutate it only through the methods below."""
+        if self._lines is None:
+            self._lines = self._text.splitlines()
+        return self._lines
+
+    @property
+    def dirty(self):
+        return self.text != self.raw
+
+    def add_line(self, line, check=True):
+        """Append `line` unless `check` finds it present; return True if added."""
+        if self._lines is not None:
+            if check and line in self._lines:
+                return False
+            self._lines.append(line)
+            self._text = None
+            return True
+        if check and has_line(self._text, line):
+            return False
+        self.text = append_line(self._text, line, self.eol)
+        return True
+
+    def set_block(self, block_lines, marker_start, marker_end):
+        block = self.eol.join([marker_start] + block_lines + [marker_end])
+        self.text = place_block(self.text, block, marker_start, marker_end, self.eol)
+
+    def replace(self, old_line, new_line):
+        """Replace every `old_line` with `new_line`; return the edits made."""
+        if self._lines is None and old_line not in self._text:
+            return []
+        edits = replace_lines(self.lines, old_line, new_line)
+        if edits and old_line != new_line:
+            self._text = None
+        return edits
+
+    def replace_re(self, pattern, replacement):
+        r"""Apply a regex replacement to every line; return (match_found, edits).
+
+        ASCII lines are matched with a bytes pattern as they are, unless they
+        hold \x1c-\x1f, which str \s matches and bytes \s does not; any
+        other lines are decoded so the str regex rules still apply."""
+        lines = self.lines
+        compiled = None
+        if (pattern.isascii() and all(map(bytes.isascii, lines))
+                and not any(map(STR_ONLY_SPACE.search, lines))):
+            try:
+                compiled = compile_pattern(to_bytes(pattern))
+            except re.error:
+                pass  # str-only syntax such as \N{...}
+        if compiled is not None:
+            new_lines, match_found, edits = replace_lines_re(lines, compiled, to_bytes(replacement))
         else:
-            new = block + '\n'
+            decoded = [l.decode("utf-8", "surrogateescape") for l in lines]
+            new_lines, match_found, edits = replace_lines_re(decoded, compile_pattern(pattern), replacement)
+            if edits:
+                new_lines = [to_bytes(l) for l in new_lines]
+                edits = [Edit(e.lineno, [lines[e.lineno]], [new_lines[e.lineno]]) for e in edits]
+        if edits:
+            self._lines = new_lines
+            self._text = None
+        return match_found, edits
 
-    if old == new:
+    def flush(self):
+        atomic_write(self.path, self.text)
+        self.raw = self.text
+
+def ensure_line(path, line, force=False, quiet=False, idempotent_ok=False):
+    line = to_bytes(line)
+    buf = FileBuffer(path, quiet, create=True)
+    if not buf.add_line(line):
         if not quiet:
-            print(f"Block already correct in {path}")
+            print(f"Line already present in {path}")
         exit_ok_or_noop(idempotent_ok)
+    old = buf.raw
+    lines = edits = None
+    if not quiet:
+        lines = old.splitlines()
+        if not old or is_plain_lines(old, lines):
+            edits = [Edit(len(lines), [], [line])]
+    confirm_and_write(buf, force, quiet, idempotent_ok, lines, edits)
 
-    confirmed = show_diff_and_confirm(old, new, path, force, quiet)
-    if confirmed is None:
+def block_in_place(path, block, marker_start, marker_end):
+    """Return True if a large file already holds `block` exactly as ensure_block
+    would write it, checked on the mapped file without reading it in.
+    Anything that can't be decided cheaply returns False."""
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < MMAP_THRESHOLD:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                first_eol = mm.find(b"\n")
+                if first_eol > 0 and mm[first_eol - 1] == 0x0d:
+                    return False  # CRLF files get a CRLF block
+                start = mm.find(marker_start)
+                if start < 1:
+                    return False
+                end_idx = mm.find(marker_end, start + len(marker_start))
+                if end_idx < 0:
+                    return False
+                end = end_idx + len(marker_end)
+                # exactly one newline on each side, as ensure_block leaves it
+                if end >= size or mm[start - 1] != 0x0a or mm[end] != 0x0a:
+                    return False
+                for i in (start - 2, end + 1):
+                    if 0 <= i < size and mm[i] in WHITESPACE:
+                        return False
+                return mm[start:end] == block
+    except OSError:
+        return False
+
+def ensure_block(path, block_lines, marker_start, marker_end,
+                 force=False, quiet=False, idempotent_ok=True):
+    marker_start, marker_end = to_bytes(marker_start), to_bytes(marker_end)
+    block_lines = [to_bytes(l) for l in block_lines]
+    block = b'\n'.join([marker_start] + block_lines + [marker_end])
+    if path.exists() and block_in_place(path, block, marker_start, marker_end):
+        if not quiet:
+            print(f"Block already correct in {path}")
         exit_ok_or_noop(idempotent_ok)
-    if confirmed:
-        try:
-            path.write_text(new, encoding="utf-8")
-        except PermissionError:
-            if not quiet:
-                print(f"Permission denied: {path}", file=sys.stderr)
-            sys.exit(EXIT_PERMISSIONS)
+    buf = FileBuffer(path, quiet, create=True)
+    buf.set_block(block_lines, marker_start, marker_end)
+
+    if not buf.dirty:
         if not quiet:
-            print(f"Updated {path}")
-        sys.exit(EXIT_OK)
+            print(f"Block already correct in {path}")
+        exit_ok_or_noop(idempotent_ok)
 
-    exit_ok_or_noop(idempotent_ok)
+    confirm_and_write(buf, force, quiet, idempotent_ok)
 
 def replace_line(path, old_line, new_line, force=False, quiet=False, idempotent_ok=False):
-    path = Path(path)
-    old = safe_read(path, quiet)
-    lines = old.splitlines()
-    match_found = False
-    changed = False
-    new_lines = []
-    for l in lines:
-        if l == old_line:
-            match_found = True
-            if l != new_line:
-                new_lines.append(new_line)
-                changed = True
-            else:
-                new_lines.append(l)
-        else:
-            new_lines.append(l)
-    if not match_found:
+    old_line, new_line = to_bytes(old_line), to_bytes(new_line)
+    buf = FileBuffer(path, quiet)
+    edits = buf.replace(old_line, new_line)
+    if not edits:
         if not quiet:
             print(f"No exact match found for replacement in {path}")
         sys.exit(EXIT_NO_MATCH)
-    if not changed:
+    if old_line == new_line:
         if not quiet:
             print(f"Line matched but already correct in {path}")
         exit_ok_or_noop(idempotent_ok)
-    new = '\n'.join(new_lines) + '\n'
-    confirmed = show_diff_and_confirm(old, new, path, force, quiet)
-    if confirmed is None:
-        exit_ok_or_noop(idempotent_ok)
-    if confirmed:
-        try:
-            path.write_text(new, encoding="utf-8")
-        except PermissionError:
-            if not quiet:
-                print(f"Permission denied: {path}", file=sys.stderr)
-            sys.exit(EXIT_PERMISSIONS)
-        if not quiet:
-            print(f"Updated {path}")
-        sys.exit(EXIT_OK)
-    exit_ok_or_noop(idempotent_ok)
+    lines = buf.lines
+    if not is_plain_lines(buf.raw, lines):
+        edits = None
+    confirm_and_write(buf, force, quiet, idempotent_ok, lines, edits)
 
 def replace_line_re(path, pattern, replacement, force=False, quiet=False, idempotent_ok=False):
-    path = Path(path)
-    old = safe_read(path, quiet)
-    lines = old.splitlines()
-    match_found = False
-    changed = False
-    new_lines = []
-    for l in lines:
-        if re.search(pattern, l):
-            match_found = True
-        new_l = re.sub(pattern, replacement, l)
-        if new_l != l:
-            changed = True
-        new_lines.append(new_l)
+    buf = FileBuffer(path, quiet)
+    old_lines = buf.lines
+    match_found, edits = buf.replace_re(pattern, replacement)
     if not match_found:
         if not quiet:
             print(f"No regex matches found in {path}")
         sys.exit(EXIT_NO_MATCH)
-    if not changed:
+    if not edits:
         if not quiet:
             print(f"Regex match found, but no changes needed in {path}")
         exit_ok_or_noop(idempotent_ok)
-    new = '\n'.join(new_lines) + '\n'
-    confirmed = show_diff_and_confirm(old, new, path, force, quiet)
-    if confirmed is None:
-        exit_ok_or_noop(idempotent_ok)
-    if confirmed:
-        try:
-            path.write_text(new, encoding="utf-8")
-        except PermissionError:
-            if not quiet:
-                print(f"Permission denied: {path}", file=sys.stderr)
-            sys.exit(EXIT_PERMISSIONS)
-        if not quiet:
-            print(f"Updated {path}")
-        sys.exit(EXIT_OK)
-    exit_ok_or_noop(idempotent_ok)
+    if not is_plain_lines(buf.raw, old_lines):
+        edits = None
+    confirm_and_write(buf, force, quiet, idempotent_ok, old_lines, edits)
+
+def batch(path, operations, force=False, quiet=False, idempotent_ok=True):
+    """Apply several operations to one file with a single read, diff and write.
 
-def main():
+    `operations` is a sequence of tuples named after the CLI options:
+    ("line", LINE), ("block", LINES, START, END), ("replace", FROM, TO) and
+    ("replace_re", PATTERN, REPLACEMENT). They are applied in order to one
+    FileBuffer, and nothing is written if any replacement finds no match.
+    Returns an exit code like run()."""
+    path = Path(path)
+    try:
+        # like running the CLI once per operation: only a leading line or
+        # block may create the file, anything else needs it to exist
+        create = bool(operations) and operations[0][0] in ("line", "block")
+        buf = FileBuffer(path, quiet, create=create)
+        for op in operations:
+            kind, args = op[0], op[1:]
+            if kind == "line":
+                buf.add_line(to_bytes(args[0]))
+            elif kind == "block":
+                block_lines, marker_start, marker_end = args
+                marker_start, marker_end = to_bytes(marker_start), to_bytes(marker_end)
+                buf.set_block([to_bytes(l) for l in block_lines], marker_start, marker_end)
+            elif kind == "replace":
+                old_line, new_line = map(to_bytes, args)
+                if not buf.replace(old_line, new_line):
+                    if not quiet:
+                        print(f"No exact match found for replacement in {path}")
+                    sys.exit(EXIT_NO_MATCH)
+            elif kind == "replace_re":
+                pattern, replacement = args
+                match_found, _ = buf.replace_re(pattern, replacement)
+                if not match_found:
+                    if not quiet:
+                        print(f"No regex matches found in {path}")
+                    sys.exit(EXIT_NO_MATCH)
+            else:
+                raise ValueError(f"Unknown operation: {kind}")
+        confirm_and_write(buf, force, quiet, idempotent_ok)
+    except SystemExit as e:
+        return e.code
+    except Exception as e:
+        print(f"Unhandled error: {e}", file=sys.stderr)
+        return EXIT_GENERIC_FAIL
+    return EXIT_OK
+
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("filepath")
     parser.add_argument("--line", help="Line to ensure")
@@ -201,24 +644,31 @@ def main():
     parser.add_argument("-f", "--force", action="store_true", help="Apply without prompting")
     parser.add_argument("-q", "--quiet", action="store_true", help="Suppress diff and messages")
     parser.add_argument("-I", "--idempotent-fail", action="store_true", help="Treat 'already correct' as failure (exit 4)")
-    args = parser.parse_args()
+    return parser
 
+def run(argv=None):
+    """Run one ensure_file invocation in-process and return its exit code."""
+    parser = build_parser()
     try:
+        args = parser.parse_args(argv)
+        filepath = Path(args.filepath)
         if args.line:
-            ensure_line(args.filepath, args.line, args.force, args.quiet, not args.idempotent_fail)
+            ensure_line(filepath, args.line, args.force, args.quiet, not args.idempotent_fail)
         elif args.block and args.start and args.end:
-            ensure_block(args.filepath, args.block, args.start, args.end, args.force, args.quiet, not args.idempotent_fail)
+            ensure_block(filepath, args.block, args.start, args.end, args.force, args.quiet, not args.idempotent_fail)
         elif args.replace:
-            replace_line(args.filepath, args.replace[0], args.replace[1], args.force, args.quiet, not args.idempotent_fail)
+            replace_line(filepath, args.replace[0], args.replace[1], args.force, args.quiet, not args.idempotent_fail)
         elif args.replace_re:
-            replace_line_re(args.filepath, args.replace_re[0], args.replace_re[1], args.force, args.quiet, not args.idempotent_fail)
+            replace_line_re(filepath, args.replace_re[0], args.replace_re[1], args.force, args.quiet, not args.idempotent_fail)
         else:
             print("Error: Must specify --line, --block with --start/--end, --replace, or --replace-re", file=sys.stderr)
-            sys.exit(EXIT_GENERIC_FAIL)
+            return EXIT_GENERIC_FAIL
+    except SystemExit as e:
+        return e.code
     except Exception as e:
         print(f"Unhandled error: {e}", file=sys.stderr)
-        sys.exit(EXIT_GENERIC_FAIL)
+        return EXIT_GENERIC_FAIL
+    return EXIT_OK
 
 if __name__ == "__main__":
-    main()
-
+    sys.exit(run(sys.argv[1:]))
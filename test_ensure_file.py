@@ -1,7 +1,12 @@
+import difflib
+import io
 import subprocess
 import os
 import pytest
 from pathlib import Path
+from unittest import mock
+
+import ensure_file
 
 SCRIPT = "./ensure_file.py"
 TESTFILE = "/tmp/ensure_python_test.conf"
@@ -15,6 +20,11 @@ def clean_file():
         os.remove(TESTFILE)
 
 def run(args, input=None):
+    with mock.patch("sys.stdin", io.StringIO(input or "")):
+        code = ensure_file.run(args)
+    return subprocess.CompletedProcess([SCRIPT] + args, code)
+
+def run_script(args, input=None):
     proc = subprocess.run(
         [SCRIPT] + args,
         input=input,
@@ -26,6 +36,20 @@ def run(args, input=None):
 def readfile():
     return Path(TESTFILE).read_text(encoding="utf-8")
 
+# -- CLI --
+
+def test_script_smoke():
+    Path(TESTFILE).write_text("alpha\n")
+    result = run_script([TESTFILE, "--line", "beta", "-f", "-q"])
+    assert result.returncode == 0
+    assert readfile() == "alpha\nbeta\n"
+
+def test_prompt_declined():
+    Path(TESTFILE).write_text("alpha\n")
+    result = run([TESTFILE, "--line", "beta"], input="n\n")
+    assert result.returncode == 0
+    assert readfile() == "alpha\n"
+
 # -- LINE tests --
 
 def test_ensure_line_on_empty_file():
@@ -48,6 +72,12 @@ def test_ensure_line_first_last_middle():
         "hello = world"
     ]
 
+def test_ensure_line_no_trailing_newline():
+    Path(TESTFILE).write_text("alpha")
+    result = run([TESTFILE, "--line", "beta", "-f", "-q"])
+    assert result.returncode == 0
+    assert readfile() == "alpha\nbeta\n"
+
 def test_ensure_line_idempotent_and_I():
     Path(TESTFILE).write_text("alpha\n")
     result = run([TESTFILE, "--line", "alpha", "-q"])
@@ -57,6 +87,13 @@ def test_ensure_line_idempotent_and_I():
     assert result2.returncode == 0
     assert readfile() == "alpha\n"
 
+def test_ensure_line_creates_file_with_umask_mode():
+    result = run([TESTFILE, "--line", "alpha", "-f", "-q"])
+    assert result.returncode == 0
+    umask = os.umask(0)
+    os.umask(umask)
+    assert os.stat(TESTFILE).st_mode & 0o777 == 0o666 & ~umask
+
 # -- REPLACE exact line --
 
 def test_replace_line_exact():
@@ -80,6 +117,12 @@ def test_replace_line_no_match():
     assert result.returncode == 3
     assert readfile() == "something else\n"
 
+def test_replace_line_all_occurrences():
+    Path(TESTFILE).write_text("a=1\nb=2\na=1\n")
+    result = run([TESTFILE, "--replace", "a=1", "a=5", "-f", "-q"])
+    assert result.returncode == 0
+    assert readfile() == "a=5\nb=2\na=5\n"
+
 # -- REPLACE regex --
 
 def test_replace_re_changes_line():
@@ -122,6 +165,17 @@ def test_replace_first_and_last_line():
     assert r2.returncode == 0
     assert readfile() == "top=9\nmid=2\nbot=9\n"
 
+def test_replace_re_non_ascii():
+    Path(TESTFILE).write_text("name = café\n", encoding="utf-8")
+    result = run([TESTFILE, "--replace-re", r"caf\w", "tea", "-f", "-q"])
+    assert result.returncode == 0
+    assert readfile() == "name = tea\n"
+
+def test_replace_re_str_whitespace():
+    Path(TESTFILE).write_bytes(b"a\x1cb\n")
+    assert run([TESTFILE, "--replace-re", r"a\sb", "X", "-f", "-q"]).returncode == 0
+    assert Path(TESTFILE).read_bytes() == b"X\n"
+
 # -- BLOCK tests --
 
 def test_block_insert_from_empty():
@@ -169,3 +223,198 @@ def test_insert_block_top_bottom_context():
     assert lines[:3] == ["AAA", "BBB", "CCC"]
     assert lines[3:7] == ["# START", "SET", "UP", "# STOP"]
 
+def test_block_identical_markers():
+    Path(TESTFILE).write_text("a\n# X\nold\n# X\nb\n")
+    result = run([
+        TESTFILE,
+        "--block", "new", "--start", "# X", "--end", "# X", "-f", "-q"
+    ])
+    assert result.returncode == 0
+    assert readfile() == "a\n# X\nnew\n# X\nb\n"
+
+def test_block_in_place_large_file():
+    filler = "x" * 100 + "\n"
+    body = filler * (ensure_file.MMAP_THRESHOLD // len(filler))
+    block = "# BEGIN\nA\n# END"
+    Path(TESTFILE).write_text(body + block + "\n" + body)
+    path = Path(TESTFILE)
+    assert ensure_file.block_in_place(path, block.encode(), b"# BEGIN", b"# END")
+    assert not ensure_file.block_in_place(path, b"# BEGIN\nB\n# END", b"# BEGIN", b"# END")
+
+    result = run([TESTFILE, "--block", "B", "--start", "# BEGIN", "--end", "# END", "-f", "-q"])
+    assert result.returncode == 0
+    assert readfile() == body + "# BEGIN\nB\n# END\n" + body
+
+# -- WRITE --
+
+def test_write_keeps_mode_and_symlink():
+    link = TESTFILE + ".link"
+    Path(TESTFILE).write_text("alpha\n")
+    os.chmod(TESTFILE, 0o600)
+    os.symlink(TESTFILE, link)
+    try:
+        result = run([link, "--line", "beta", "-f", "-q"])
+        assert result.returncode == 0
+        assert os.path.islink(link)
+        assert os.stat(TESTFILE).st_mode & 0o777 == 0o600
+        assert not [f for f in os.listdir("/tmp") if f.startswith(".ensure_python_test.conf.")]
+        assert readfile() == "alpha\nbeta\n"
+    finally:
+        os.remove(link)
+
+def test_write_leaves_other_tmp_file_alone():
+    Path(TESTFILE).write_text("alpha\n")
+    Path(TESTFILE + ".tmp").write_text("keep me\n")
+    try:
+        result = run([TESTFILE, "--line", "beta", "-f", "-q"])
+        assert result.returncode == 0
+        assert Path(TESTFILE + ".tmp").read_text() == "keep me\n"
+        assert readfile() == "alpha\nbeta\n"
+    finally:
+        os.remove(TESTFILE + ".tmp")
+
+def test_write_in_place_when_rename_denied():
+    Path(TESTFILE).write_text("alpha\n")
+    with mock.patch("os.replace", side_effect=PermissionError):
+        result = run([TESTFILE, "--line", "beta", "-f", "-q"])
+    assert result.returncode == 0
+    assert not [f for f in os.listdir("/tmp") if f.startswith(".ensure_python_test.conf.")]
+    assert readfile() == "alpha\nbeta\n"
+
+def test_write_in_place_when_owner_cannot_be_kept():
+    link = TESTFILE + ".hardlink"
+    Path(TESTFILE).write_text("alpha\n")
+    os.link(TESTFILE, link)
+    try:
+        with mock.patch("os.fchown", side_effect=PermissionError):
+            result = run([TESTFILE, "--line", "beta", "-f", "-q"])
+        assert result.returncode == 0
+        assert not [f for f in os.listdir("/tmp") if f.startswith(".ensure_python_test.conf.")]
+        assert Path(link).read_text() == "alpha\nbeta\n"
+    finally:
+        os.remove(link)
+
+def test_file_buffer_flush():
+    Path(TESTFILE).write_text("a = 1\nb = 2\n")
+    buf = ensure_file.FileBuffer(Path(TESTFILE))
+    assert not buf.dirty
+    assert buf.replace(b"a = 1", b"a = 3")
+    assert buf.add_line(b"c = 4")
+    assert not buf.add_line(b"b = 2")
+    assert buf.lines == [b"a = 3", b"b = 2", b"c = 4"]
+    assert buf.dirty
+    buf.flush()
+    assert readfile() == "a = 3\nb = 2\nc = 4\n"
+    assert not buf.dirty
+
+def test_invalid_utf8_round_trips():
+    Path(TESTFILE).write_bytes(b"bin = \xff\xfe\n")
+    result = run([TESTFILE, "--line", "ok = 1", "-f", "-q"])
+    assert result.returncode == 0
+    assert Path(TESTFILE).read_bytes() == b"bin = \xff\xfe\nok = 1\n"
+
+def test_crlf_file_keeps_crlf():
+    Path(TESTFILE).write_bytes(b"a\r\nb\r\n")
+    assert run([TESTFILE, "--line", "c", "-f", "-q"]).returncode == 0
+    assert Path(TESTFILE).read_bytes() == b"a\r\nb\r\nc\r\n"
+    assert run([TESTFILE, "--replace", "b", "B", "-f", "-q"]).returncode == 0
+    assert Path(TESTFILE).read_bytes() == b"a\r\nB\r\nc\r\n"
+    assert run([TESTFILE, "--block", "X", "--start", "# S", "--end", "# E", "-f", "-q"]).returncode == 0
+    assert Path(TESTFILE).read_bytes() == b"a\r\nB\r\nc\r\n# S\r\nX\r\n# E\r\n"
+
+# -- DIFF preview --
+
+def test_format_edits_matches_difflib():
+    lines = [f"line{i}" for i in range(20)]
+    edits = [ensure_file.Edit(2, [b"line2"], [b"two"]), ensure_file.Edit(15, [b"line15"], [b"fifteen"])]
+    new_lines = list(lines)
+    new_lines[2], new_lines[15] = "two", "fifteen"
+    expected = difflib.unified_diff(
+        [l + "\n" for l in lines], [l + "\n" for l in new_lines],
+        fromfile="f.old", tofile="f.new"
+    )
+    lines = [l.encode() for l in lines]
+    assert "".join(ensure_file.format_edits("f", lines, edits)) == "".join(expected)
+
+def test_replace_shows_diff(capsys):
+    Path(TESTFILE).write_text("a\nloglevel = debug\nb\n")
+    result = run([TESTFILE, "--replace", "loglevel = debug", "loglevel = warning", "-f"])
+    assert result.returncode == 0
+    out = capsys.readouterr().out
+    assert "@@ -1,3 +1,3 @@\n a\n-loglevel = debug\n+loglevel = warning\n b\n" in out
+
+def test_compute_diff():
+    assert ensure_file.compute_diff(b"a\n", b"a\n", "f") is None
+    assert ensure_file.compute_diff(b"a\n", b"b\n", "f") == "--- f.old\n+++ f.new\n@@ -1 +1 @@\n-a\n+b\n"
+
+def test_large_block_diff_is_trimmed(capsys):
+    body = "".join(f"line{i}\n" for i in range(1000))
+    Path(TESTFILE).write_text(body + "# BEGIN\nA\n# END\n" + body)
+    result = run([TESTFILE, "--block", "B", "--start", "# BEGIN", "--end", "# END", "-f"])
+    assert result.returncode == 0
+    out = capsys.readouterr().out
+    assert "@@ -999,7 +999,7 @@\n line998\n line999\n # BEGIN\n-A\n+B\n # END\n line0\n line1\n" in out
+
+def test_large_diff_shows_final_newline_change(capsys):
+    body = "".join(f"line{i}\n" for i in range(1000))
+    Path(TESTFILE).write_text(body + "# B\nA\n# E")
+    result = run([TESTFILE, "--block", "A", "--start", "# B", "--end", "# E", "-f"])
+    assert result.returncode == 0
+    out = capsys.readouterr().out
+    assert "@@ -1000,4 +1000,4 @@\n line999\n # B\n A\n-# E+# E\n" in out
+    assert readfile() == body + "# B\nA\n# E\n"
+
+def test_large_diff_shows_final_newline_with_other_edits(capsys):
+    body = "".join(f"line{i}\n" for i in range(1000))
+    Path(TESTFILE).write_text(body + "last")
+    result = run([TESTFILE, "--replace", "line5", "X", "-f"])
+    assert result.returncode == 0
+    out = capsys.readouterr().out
+    assert "-line5\n+X\n" in out
+    assert "-last+last\n" in out
+    assert readfile() == body.replace("line5\n", "X\n") + "last\n"
+
+# -- BATCH --
+
+def test_batch_applies_all_operations():
+    Path(TESTFILE).write_text("loglevel = debug\nvm.swappiness = 10\n")
+    code = ensure_file.batch(TESTFILE, [
+        ("replace", "loglevel = debug", "loglevel = warning"),
+        ("replace_re", r"vm\.swappiness = \d+", "vm.swappiness = 1"),
+        ("line", "extra = 1"),
+        ("line", "extra = 1"),
+        ("block", ["A"], "# BEGIN", "# END"),
+    ], force=True, quiet=True)
+    assert code == 0
+    assert readfile() == (
+        "loglevel = warning\nvm.swappiness = 1\nextra = 1\n# BEGIN\nA\n# END\n"
+    )
+
+def test_batch_no_match_writes_nothing():
+    Path(TESTFILE).write_text("alpha\n")
+    code = ensure_file.batch(TESTFILE, [
+        ("line", "beta"),
+        ("replace", "gamma", "delta"),
+    ], force=True, quiet=True)
+    assert code == 3
+    assert readfile() == "alpha\n"
+
+def test_batch_sees_lines_added_earlier():
+    Path(TESTFILE).write_text("alpha\n")
+    code = ensure_file.batch(TESTFILE, [
+        ("line", "beta = 1"),
+        ("replace", "beta = 1", "beta = 2"),
+    ], force=True, quiet=True)
+    assert code == 0
+    assert readfile() == "alpha\nbeta = 2\n"
+
+def test_batch_no_change_needed():
+    Path(TESTFILE).write_text("alpha\n")
+    assert ensure_file.batch(TESTFILE, [("line", "alpha")], force=True, quiet=True) == 0
+    assert ensure_file.batch(TESTFILE, [("line", "alpha")], force=True, quiet=True, idempotent_ok=False) == 4
+
+def test_batch_replace_missing_file():
+    Path(TESTFILE).unlink(missing_ok=True)
+    code = ensure_file.batch(TESTFILE, [("replace", "a", "b")], force=True, quiet=True)
+    assert code == 5
+    assert not Path(TESTFILE).exists()